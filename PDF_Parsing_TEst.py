@@ -152,7 +152,7 @@ class PDFProcessor:
         result = {"text": {"all_text": ''}, "tables": {}, "images": {}}
         self.pdf = fitz.open(pdf_path)
 
-        img_num = 0; page_num = 0
+        img_num = 0; page_num = 0; table_num = 0
         for page_num in range(self.pdf.page_count):
             page_num += 1
             page = self.pdf.load_page(page_num-1)
@@ -168,6 +168,14 @@ class PDFProcessor:
                 result["images"][f"image_{img_num}"] = self._get_figure(page, img)
                 result["images"][f"image_{img_num}"]["page_num"] = page_num
 
+            # Extract tables (page.find_tables needs PyMuPDF >= 1.23)
+            if hasattr(page, "find_tables"):
+                for tab in page.find_tables().tables:
+                    table_num += 1
+                    result["tables"][f"table_{table_num}"] = {"page_num": page_num,
+                                                              "bbox": list(tab.bbox),
+                                                              "dataframe": tab.to_pandas()}
+
         result["text"].update(self._filter_text(result["text"]["all_text"]))
         result["metadata"] = self.pdf.metadata
         self.pdf.close()
@@ -176,77 +184,115 @@ class PDFProcessor:
 
 #%%
 import chromadb
-from sentence_transformers import SentenceTransformer
+from embedding import EmbeddingEngine
+from ralph_service import RalphClient
+from paper_search import query_papers
+from table_store import TableStore
+from doc_index import DocIndex, IndexedCollection, doc_id_for
 import json
 import base64
 
 class PDFVectorStorage:
-    def __init__(self, collection_name):
+    def __init__(self, collection_name, backend="torch", num_threads=None, service=None):
+
+        # Share the model and store of a running ralph_service instead of loading our own
+        if service:
+            self.client = RalphClient(service)
+            self.collection = self.client.get_or_create_collection(collection_name)
+            self.model = self.client
+            self.tables = self.client.table_store()
+            return
 
         # Initialize Chroma
         self.client = chromadb.PersistentClient(path="./db")
 
         # Check if collection already exists and use it, otherwise create it
         try:
-            self.collection = self.client.create_collection(collection_name)
+            collection = self.client.create_collection(collection_name)
         except chromadb.errors.UniqueConstraintError:
-            self.collection = self.client.get_collection(collection_name)
+            collection = self.client.get_collection(collection_name)
+
+        # doc_id -> chunk ids, kept next to the store for per-paper upsert and delete
+        self.collection = IndexedCollection(collection, DocIndex(f"./db/doc_index_{collection_name}.jsonl"))
 
         # Load a pre-trained model to generate embeddings
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.model = EmbeddingEngine('all-MiniLM-L6-v2', backend=backend, num_threads=num_threads)
+
+        # Extracted tables, stored column by column with a header index
+        self.tables = TableStore(embedder=self.model)
         return
 
     def _create_embeddings(self, text):
         return self.model.encode(text)
 
-    def _update_db(self, doc_id, filepath, pdf: dict):
+    def _update_db(self, doc_id, file_path, pdf: dict):
+        # Every chunk of the paper is collected first and written in one upsert,
+        # so re-uploading a paper replaces it instead of failing or duplicating
+        ids, embeddings, metadatas, documents = [], [], [], []
+
         # Add main text embedding
         text_embedding = self._create_embeddings(pdf["text"]["text"])
 
         metadata = {"type": "text",
-                    "filepath": filepath,
+                    "file_path": file_path,
                     "doc_id": doc_id
                     }
         metadata.update(pdf["metadata"])
         metadata = {key: str(value) for key, value in metadata.items()}
 
         # Convert the dictionary into a JSON string
-        document_json = json.dumps(pdf["text"])
-
-        self.collection.add(ids=[f"{doc_id}_text"],
-                            embeddings=[text_embedding],
-                            metadatas=[metadata],
-                            documents=[document_json]
-                            )
+        ids.append(f"{doc_id}_text")
+        embeddings.append(text_embedding.tolist())
+        metadatas.append(dict(metadata))
+        documents.append(json.dumps(pdf["text"]))
 
         # Add figure captions with file path and citation
-        metadata.update({"type": "image"})
-        for key in pdf["images"].keys():  # figures is now a list of captions (strings)
-            if "caption" in pdf["images"][key].keys():
-                caption_embedding = self._create_embeddings(pdf["images"][key]["caption"])  # Treat caption as a string
+        metadata.update({"type": "figure"})
+        keys = [key for key in pdf["images"].keys() if "caption" in pdf["images"][key].keys()]
+        if keys:
+            # Encode every caption in one bucketed call instead of one at a time
+            caption_embeddings = self._create_embeddings([pdf["images"][key]["caption"] for key in keys])
+            for key, caption_embedding in zip(keys, caption_embeddings):
                 pdf["images"][key]["image_bytes"] = base64.b64encode(pdf["images"][key]["image_bytes"]).decode('utf-8')
 
                 # Convert the dictionary into a JSON string
-                document_json = json.dumps(pdf["images"][key])
-                self.collection.add(ids=[f"{doc_id}_{key}"],
-                                    embeddings=[caption_embedding],
-                                    metadatas=[metadata],
-                                    documents=[document_json]
-                                    )
+                ids.append(f"{doc_id}_{key}")
+                embeddings.append(caption_embedding.tolist())
+                metadatas.append(dict(metadata))
+                documents.append(json.dumps(pdf["images"][key]))
 
-        # Add figure captions with file path and citation
+        # Tables go to the columnar store; Chroma only indexes their headers
         metadata.update({"type": "table"})
-        for key in pdf["tables"].keys():  # figures is now a list of captions (strings)
-            if "caption" in pdf["tables"][key].keys():
-                caption_embedding = self._create_embeddings(pdf["tables"][key]["caption"])  # Treat caption as a string
+        keys = list(pdf["tables"].keys())
+        if keys:
+            table_ids = self.tables.add_tables(doc_id,
+                                               [pdf["tables"][key]["dataframe"] for key in keys],
+                                               pages=[pdf["tables"][key]["page_num"] for key in keys],
+                                               captions=[pdf["tables"][key].get("caption") for key in keys])
+            headers = []
+            for key, table_id in zip(keys, table_ids):
+                columns = self.tables.columns(table_id)
+                caption = pdf["tables"][key].get("caption")
+                headers.append(f"{caption}: {', '.join(columns)}" if caption else f"Table: {', '.join(columns)}")
+
+                # The rows live in the table store, the document only points at them
+                ids.append(table_id)
+                metadatas.append(dict(metadata))
+                documents.append(json.dumps({"table_id": table_id,
+                                             "page_num": pdf["tables"][key]["page_num"],
+                                             "bbox": pdf["tables"][key]["bbox"],
+                                             "columns": columns}))
+            embeddings.extend(self._create_embeddings(headers).tolist())
+        else:
+            self.tables.delete_document(doc_id)
+
+        self.collection.upsert_document(doc_id, ids, embeddings, metadatas, documents)
+        return
 
-                # Convert the dictionary into a JSON string
-                document_json = json.dumps(pdf["tables"][key])
-                self.collection.add(ids=[f"{doc_id}_{key}"],
-                                    embeddings=[caption_embedding],
-                                    metadatas=[metadata],
-                                    documents=[document_json]
-                                    )
+    def _delete_document(self, doc_id):
+        # Removes one paper's rows via the doc_id index, leaving the rest of the library alone
+        self.collection.delete_document(doc_id)
+        self.tables.delete_document(doc_id)
         return
 
     def _query_db(self, query, collection, num_results=100):
@@ -258,10 +304,17 @@ class PDFVectorStorage:
         return results
 
     def _unique_filepaths(self, query_results):
-        filepaths = [metadata['filepath'] for metadata in query_results['metadatas'][0]]
-        return list(set(filepaths))
+        filepaths = [metadata.get('file_path') for metadata in query_results['metadatas'][0]]
+        return list(set(filepath for filepath in filepaths if filepath))
+
+    def _query_papers(self, query, k=10, aggregator="max", top_n=3, mmr_lambda=None, snippets=3):
+        # Ranked papers with their best-matching snippets, rather than 100 raw chunks
+        query_embedding = self._create_embeddings(query)
+        return query_papers(self.collection, query_embedding, k=k, aggregator=aggregator,
+                            top_n=top_n, mmr_lambda=mmr_lambda, snippets=snippets)
 
 #%%
+import os
 import time
 from pathlib import Path
 
@@ -270,13 +323,13 @@ start_time = time.time()
 
 pdf_files = [x for x in Path("./pdfs").glob("*.pdf")]  # Replace with the path to your PDF file
 
-storage = PDFVectorStorage("research_papers")
+storage = PDFVectorStorage("research_papers", service=os.environ.get("RALPH_SERVICE"))
 
 test = {}
 for file in pdf_files:
-    filepath = str(file.resolve())
+    doc_id = doc_id_for(file)
     test[file.name] = PDFProcessor(file).result
-    storage._update_db(doc_id=filepath, filepath=filepath, pdf=test[file.name])
+    storage._update_db(doc_id=doc_id, file_path=doc_id, pdf=test[file.name])
 
 # End timing
 end_time = time.time()
@@ -292,6 +345,9 @@ print(f"Total execution time: {elapsed_time:.2f} seconds")
 
 #%%
 
+# # Remove or re-index a single paper without rebuilding the library
+# storage._delete_document(doc_id=doc_id_for(file))
+
 # # Initialize Chroma
 # client = chromadb.PersistentClient(path="./db")
 
@@ -0,0 +1,141 @@
+"""
+doc_id -> chunk id index for per-paper upsert and delete.
+"""
+
+import os
+import json
+
+
+def doc_id_for(pdf_path):
+    """
+    The one doc_id scheme for every writer to the store: the resolved path
+    of the PDF, which is also what goes in the "file_path" metadata key.
+    """
+    return os.path.realpath(pdf_path)
+
+
+class DocIndex:
+    """
+    doc_id -> chunk ids, maintained at ingest so a paper can be replaced or
+    removed without scanning the collection.
+
+    With a path, changes are appended to a JSON-lines log and replayed on
+    load; the log is compacted once it is mostly superseded entries.
+    Without a path the index lives in memory only (for chromadb.Client()).
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.docs = {}
+        self._log_lines = 0
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    if entry["ids"] is None:
+                        self.docs.pop(entry["doc_id"], None)
+                    else:
+                        self.docs[entry["doc_id"]] = entry["ids"]
+                    self._log_lines += 1
+            if self._log_lines > 2 * len(self.docs) + 100:
+                self._compact()
+        return
+
+    def __len__(self):
+        return len(self.docs)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.docs
+
+    def get(self, doc_id):
+        return list(self.docs.get(doc_id, []))
+
+    def doc_ids(self):
+        return list(self.docs.keys())
+
+    def _append(self, doc_id, ids):
+        if not self.path:
+            return
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"doc_id": doc_id, "ids": ids}) + "\n")
+        self._log_lines += 1
+        if self._log_lines > 2 * len(self.docs) + 100:
+            self._compact()
+        return
+
+    def _compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for doc_id, ids in self.docs.items():
+                f.write(json.dumps({"doc_id": doc_id, "ids": ids}) + "\n")
+        os.replace(tmp_path, self.path)
+        self._log_lines = len(self.docs)
+        return
+
+    def set(self, doc_id, ids):
+        self.docs[doc_id] = list(ids)
+        self._append(doc_id, self.docs[doc_id])
+        return
+
+    def remove(self, doc_id):
+        if self.docs.pop(doc_id, None) is not None:
+            self._append(doc_id, None)
+        return
+
+    def rebuild(self, collection, batch_size=10000):
+        # One full scan, for collections ingested before the index existed
+        self.docs = {}
+        offset = 0
+        while True:
+            batch = collection.get(include=["metadatas"], limit=batch_size, offset=offset)
+            for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]):
+                doc_id = (metadata or {}).get("doc_id", chunk_id)
+                self.docs.setdefault(doc_id, []).append(chunk_id)
+            if len(batch["ids"]) < batch_size:
+                break
+            offset += batch_size
+        if self.path:
+            self._compact()
+        return
+
+
+class IndexedCollection:
+    """
+    A Chroma collection plus its DocIndex. Adds document-level upsert and
+    delete that touch only that paper's rows; everything else is passed
+    through to the collection.
+    """
+
+    def __init__(self, collection, index):
+        self.collection = collection
+        self.index = index
+        if not len(self.index) and self.collection.count():
+            self.index.rebuild(self.collection)
+        return
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def upsert_document(self, doc_id, ids, embeddings, metadatas=None, documents=None):
+        """
+        Replaces every chunk of doc_id with the given ones. Chunks of the old
+        version that are not in ids are deleted, the rest are upserted.
+        """
+        stale = set(self.index.get(doc_id)) - set(ids)
+        if stale:
+            self.collection.delete(ids=list(stale))
+        kwargs = {"metadatas": metadatas} if metadatas is not None else {}
+        if documents is not None:
+            kwargs["documents"] = documents
+        self.collection.upsert(ids=ids, embeddings=embeddings, **kwargs)
+        self.index.set(doc_id, ids)
+        return
+
+    def delete_document(self, doc_id):
+        ids = self.index.get(doc_id)
+        if ids:
+            self.collection.delete(ids=ids)
+        self.index.remove(doc_id)
+        return ids
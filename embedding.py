@@ -0,0 +1,192 @@
+"""
+Pluggable CPU embedding engine with length-bucketed batching.
+"""
+
+import os
+import time
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+BACKENDS = ("torch", "int8", "onnx")
+
+
+class EmbeddingEngine:
+    """
+    Wraps a SentenceTransformer behind a single encode() call.
+
+    Inputs are sorted into length buckets and batched under a token budget,
+    so full-paper text, captions and tables don't pad each other out.
+    backend picks the CPU execution path:
+        "torch" - the reference fp32 model
+        "int8"  - torch dynamic int8 quantization of the Linear layers
+        "onnx"  - ONNX Runtime on an exported copy of the transformer
+    """
+
+    def __init__(self, model_name='all-MiniLM-L6-v2', backend="torch", num_threads=None,
+                 max_batch_size=64, max_batch_tokens=8192, onnx_path=None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown embedding backend '{backend}', expected one of {BACKENDS}")
+
+        self.model_name = model_name
+        self.backend = backend
+        self.num_threads = num_threads
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.onnx_path = onnx_path or os.path.join("./models", model_name.replace("/", "_") + ".onnx")
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.tokenizer = self.model.tokenizer
+        self.max_seq_length = self.model.max_seq_length
+        self.normalize = any(type(module).__name__ == "Normalize" for module in self.model)
+        self._reference = None
+
+        if backend == "int8":
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif backend == "onnx":
+            self._session = self._load_onnx()
+        return
+
+    def _load_onnx(self):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("The 'onnx' embedding backend needs onnxruntime (pip install onnxruntime)") from e
+
+        if not os.path.exists(self.onnx_path):
+            self._export_onnx()
+
+        options = ort.SessionOptions()
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+            options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return ort.InferenceSession(self.onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def _export_onnx(self):
+        os.makedirs(os.path.dirname(self.onnx_path) or ".", exist_ok=True)
+        transformer = self.model[0].auto_model
+        transformer.eval()
+        dummy = self.tokenizer(["export"], return_tensors="pt")
+        dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"},
+                        "attention_mask": {0: "batch", 1: "sequence"},
+                        "token_type_ids": {0: "batch", 1: "sequence"},
+                        "last_hidden_state": {0: "batch", 1: "sequence"}}
+        with torch.no_grad():
+            torch.onnx.export(transformer,
+                              (dummy["input_ids"], dummy["attention_mask"], dummy["token_type_ids"]),
+                              self.onnx_path,
+                              input_names=["input_ids", "attention_mask", "token_type_ids"],
+                              output_names=["last_hidden_state"],
+                              dynamic_axes=dynamic_axes,
+                              opset_version=12)
+        return
+
+    def _token_lengths(self, texts):
+        # Estimated from characters (~4 per token) so bucketing doesn't tokenize
+        # everything a second time; only the ordering has to be roughly right
+        return [min(len(text) // 4 + 2, self.max_seq_length) for text in texts]
+
+    def _buckets(self, texts):
+        # Sort by token length and cut batches so batch_size * longest <= token budget
+        lengths = self._token_lengths(texts)
+        order = sorted(range(len(texts)), key=lambda i: lengths[i])
+
+        batch = []
+        for i in order:
+            longest = max(lengths[i], 1)
+            if batch and ((len(batch) + 1) * longest > self.max_batch_tokens
+                          or len(batch) >= self.max_batch_size):
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+        return
+
+    def _encode_onnx(self, texts):
+        inputs = self.tokenizer(texts, padding=True, truncation=True,
+                                max_length=self.max_seq_length, return_tensors="np")
+        feeds = {node.name: inputs[node.name].astype(np.int64) for node in self._session.get_inputs()}
+        token_embeddings = self._session.run(None, feeds)[0]
+
+        # Mean pooling over real tokens, matching the sentence-transformers Pooling module
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        embeddings = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+    def _encode_batch(self, texts):
+        if self.backend == "onnx":
+            return self._encode_onnx(texts)
+        return self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True,
+                                 show_progress_bar=False)
+
+    def encode(self, texts):
+        """
+        Encodes a string or a list of strings. Returns a single vector for a
+        string and an (n, dim) array for a list, in the input order.
+        """
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        if not texts:
+            return np.zeros((0, self.model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+        embeddings = None
+        for batch in self._buckets(texts):
+            batch_embeddings = self._encode_batch([texts[i] for i in batch])
+            if embeddings is None:
+                embeddings = np.zeros((len(texts), batch_embeddings.shape[1]), dtype=np.float32)
+            embeddings[batch] = batch_embeddings
+
+        return embeddings[0] if single else embeddings
+
+    def validate(self, texts):
+        """
+        Compares this engine against the fp32 reference model on texts and
+        reports cosine agreement and throughput, so a faster backend can be
+        picked knowing what it costs in accuracy.
+        """
+        if self._reference is None:
+            self._reference = SentenceTransformer(self.model_name, device="cpu")
+
+        start = time.perf_counter()
+        reference = self._reference.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+        reference_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        candidate = self.encode(texts)
+        candidate_seconds = time.perf_counter() - start
+
+        norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+        cosine = (reference * candidate).sum(axis=1) / np.clip(norms, 1e-12, None)
+        return {"backend": self.backend,
+                "num_texts": len(texts),
+                "cosine_mean": float(cosine.mean()),
+                "cosine_min": float(cosine.min()),
+                "cosine_p5": float(np.percentile(cosine, 5)),
+                "reference_seconds": reference_seconds,
+                "seconds": candidate_seconds,
+                "speedup": reference_seconds / candidate_seconds if candidate_seconds else float("inf")}
+
+
+if __name__ == '__main__':
+    # Validation mode: python embedding.py int8 onnx
+    import sys
+    from pathlib import Path
+    import fitz  # PyMuPDF
+
+    texts = []
+    for file in Path("./pdfs").glob("*.pdf"):
+        with fitz.open(file) as pdf:
+            texts.extend(page.get_text("text") for page in pdf)
+    texts = [text for text in texts if text.strip()] or ["Reference Manager"]
+
+    for backend in sys.argv[1:] or ["int8"]:
+        engine = EmbeddingEngine('all-MiniLM-L6-v2', backend=backend)
+        print(engine.validate(texts))
@@ -0,0 +1,254 @@
+"""
+Cost-ordered, cancellable ingest queue behind the GUI.
+"""
+
+import os
+import heapq
+import itertools
+import threading
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from thumbnails import FITZ_LOCK
+
+QUEUED, RUNNING, PAUSED, CANCELLED, DONE, FAILED = "queued", "running", "paused", "cancelled", "done", "failed"
+# Reported while a running job waits for its next checkpoint to pause; job.state stays RUNNING
+PAUSING = "pausing"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobPaused(Exception):
+    pass
+
+
+def estimate_cost(pdf_path):
+    # Cheap enough for the GUI thread: ~100 KB per page from the file size
+    try:
+        return max(1, os.path.getsize(pdf_path) // 100_000)
+    except OSError:
+        return 1
+
+
+def page_count(pdf_path):
+    # The real cost, read by a worker since opening every PDF would stall the GUI
+    try:
+        import fitz  # PyMuPDF
+        # Workers and the thumbnail pool share PyMuPDF, which is not thread-safe
+        with FITZ_LOCK, fitz.open(pdf_path) as pdf:
+            return pdf.page_count
+    except Exception:
+        return None
+
+
+class IngestJob:
+    def __init__(self, job_id, path, cost):
+        self.job_id = job_id
+        self.path = path
+        self.cost = cost
+        self.state = QUEUED
+        self.cost_refined = False
+        self.running = False
+        self._pause_requested = False
+        self._cancelled = False
+
+    @property
+    def pausing(self):
+        # Paused by the user but still on a worker until its next checkpoint
+        return self.running and self._pause_requested
+
+    def checkpoint(self):
+        """
+        Called by the work function between pages. Raises JobCancelled or
+        JobPaused so the job gives its worker back to the queue.
+        """
+        if self._cancelled:
+            raise JobCancelled(self.path)
+        if self._pause_requested:
+            raise JobPaused(self.path)
+
+
+class IngestScheduler(QObject):
+    """
+    Queues ingest jobs across uploads and runs them cheapest first on one
+    shared pool of worker threads, so small papers become searchable before
+    a large one finishes. work(path, checkpoint) does the actual ingest.
+
+    Signals are emitted from worker threads; Qt queues them to the GUI thread.
+    """
+    job_added = pyqtSignal(int, str)
+    job_state = pyqtSignal(int, str)
+    queue_changed = pyqtSignal(int, int)  # finished jobs, total jobs
+
+    def __init__(self, work, workers=2):
+        super().__init__()
+        self.work = work
+        self.jobs = {}
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._finished = 0
+
+        self._workers = [threading.Thread(target=self._run, daemon=True, name=f"ingest-{i}")
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def _push(self, job):
+        # Caller holds the condition; ties keep submission order
+        heapq.heappush(self._heap, (job.cost, next(self._order), job.job_id))
+        self._condition.notify()
+
+    def submit(self, paths):
+        new_jobs = [IngestJob(next(self._ids), path, estimate_cost(path)) for path in paths]
+        with self._condition:
+            for job in new_jobs:
+                self.jobs[job.job_id] = job
+                self._push(job)
+        for job in new_jobs:
+            self.job_added.emit(job.job_id, job.path)
+        self._emit_counts()
+        return [job.job_id for job in new_jobs]
+
+    def pause(self, job_id):
+        with self._condition:
+            job = self.jobs[job_id]
+            if job.state == RUNNING:
+                # The worker gives the job up at its next checkpoint and reports PAUSED
+                if job._pause_requested:
+                    return
+                job._pause_requested = True
+                state = PAUSING
+            elif job.state == QUEUED:
+                job.state = state = PAUSED
+            else:
+                return
+        self.job_state.emit(job_id, state)
+
+    def resume(self, job_id):
+        with self._condition:
+            job = self.jobs[job_id]
+            if job.running:
+                # Takes back a pause the worker has not reached yet
+                if not job._pause_requested:
+                    return
+                job._pause_requested = False
+                state = RUNNING
+            elif job.state == PAUSED:
+                # Back in line by cost; a job paused mid-run starts over, which upserts cleanly
+                job.state = state = QUEUED
+                self._condition.notify()
+            else:
+                return
+        self.job_state.emit(job_id, state)
+
+    def cancel(self, job_id):
+        with self._condition:
+            job = self.jobs[job_id]
+            if job.state in (DONE, FAILED, CANCELLED):
+                return
+            job._cancelled = True
+            if job.running:
+                return  # The worker reports it at the next checkpoint
+            job.state = CANCELLED
+            self._finished += 1
+        self.job_state.emit(job_id, CANCELLED)
+        self._emit_counts()
+
+    def cancel_all(self):
+        for job_id in list(self.jobs):
+            self.cancel(job_id)
+
+    def shutdown(self):
+        self.cancel_all()
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+    def _emit_counts(self):
+        with self._condition:
+            finished, total = self._finished, len(self.jobs)
+        self.queue_changed.emit(finished, total)
+
+    def _next_job(self):
+        with self._condition:
+            while True:
+                if self._stopping:
+                    return None
+                # Skip cancelled and paused jobs; paused ones are held aside until resumed
+                held = []
+                job = None
+                while self._heap:
+                    entry = heapq.heappop(self._heap)
+                    candidate = self.jobs[entry[2]]
+                    if candidate.state == QUEUED:
+                        job = candidate
+                        break
+                    if candidate.state == PAUSED:
+                        held.append(entry)
+                for entry in held:
+                    heapq.heappush(self._heap, entry)
+                if job is not None:
+                    job.state = RUNNING
+                    job.running = True
+                    job._pause_requested = False
+                    return job
+                self._condition.wait(timeout=0.5)
+
+    def _refine_cost(self, job):
+        """
+        Swaps the size-based estimate for the page count the first time a job
+        is picked. Returns True if that put a cheaper job ahead of it, in
+        which case the job has gone back on the heap.
+        """
+        pages = page_count(job.path)
+        with self._condition:
+            job.cost_refined = True
+            if pages is None:
+                return False
+            job.cost = pages
+            cheaper = any(cost < job.cost and self.jobs[job_id].state == QUEUED
+                          for cost, _, job_id in self._heap)
+            if not cheaper or job._cancelled or job._pause_requested:
+                return False
+            job.running = False
+            job.state = QUEUED
+            self._push(job)
+            return True
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            if not job.cost_refined and self._refine_cost(job):
+                continue
+            self.job_state.emit(job.job_id, RUNNING)
+            try:
+                job.checkpoint()
+                self.work(job.path, job.checkpoint)
+                state = DONE
+            except JobCancelled:
+                state = CANCELLED
+            except JobPaused:
+                state = PAUSED
+            except Exception as e:
+                print(f"Failed to ingest {job.path}: {e}")
+                state = FAILED
+
+            with self._condition:
+                job.running = False
+                if state == PAUSED and job._cancelled:
+                    state = CANCELLED
+                job.state = state
+                if state == PAUSED:
+                    # Parked on the heap, so this worker moves on to the next job
+                    self._push(job)
+                else:
+                    self._finished += 1
+            self.job_state.emit(job.job_id, state)
+            if state != PAUSED:
+                self._emit_counts()
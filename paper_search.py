@@ -0,0 +1,126 @@
+"""
+Paper-level ranking over chunk hits, with per-paper aggregation and MMR.
+"""
+
+import numpy as np
+
+AGGREGATORS = ("max", "sum", "mean_top_n")
+
+
+def _similarities(distances, space):
+    # Chroma returns distances; turn them into "higher is better" similarities
+    distances = np.asarray(distances, dtype=np.float32)
+    if space == "l2":
+        # Squared L2 between unit vectors is 2 - 2cos
+        return 1.0 - distances / 2.0
+    return 1.0 - distances
+
+
+def aggregate(scores, aggregator="max", top_n=3):
+    """
+    Collapses the chunk scores of one paper into a paper score.
+    aggregator is "max", "sum", "mean_top_n" or a callable taking a list of scores.
+    """
+    if callable(aggregator):
+        return float(aggregator(scores))
+    if aggregator == "max":
+        return float(max(scores))
+    if aggregator == "sum":
+        return float(sum(scores))
+    if aggregator == "mean_top_n":
+        best = sorted(scores, reverse=True)[:top_n]
+        return float(sum(best) / len(best))
+    raise ValueError(f"Unknown aggregator '{aggregator}', expected one of {AGGREGATORS}")
+
+
+def mmr(candidates, embeddings, k, mmr_lambda=0.7):
+    """
+    Maximal marginal relevance: greedily picks k candidates trading relevance
+    against similarity to the ones already picked.
+    candidates is a list of (key, relevance); embeddings maps key -> vector.
+    """
+    vectors = {key: np.asarray(embeddings[key], dtype=np.float32) for key, _ in candidates}
+    for key in vectors:
+        vectors[key] /= max(np.linalg.norm(vectors[key]), 1e-12)
+
+    selected = []
+    remaining = list(candidates)
+    while remaining and len(selected) < k:
+        best_index, best_value = 0, -np.inf
+        for index, (key, relevance) in enumerate(remaining):
+            redundancy = max((float(vectors[key] @ vectors[chosen]) for chosen, _ in selected), default=0.0)
+            value = mmr_lambda * relevance - (1 - mmr_lambda) * redundancy
+            if value > best_value:
+                best_index, best_value = index, value
+        selected.append(remaining.pop(best_index))
+    return selected
+
+
+def query_papers(collection, query_embedding, k=10, aggregator="max", top_n=3, mmr_lambda=None,
+                 mmr_pool=3, snippets=3, where=None, initial_fetch=None, max_fetch=1000):
+    """
+    Returns the top-k papers for a query instead of the top chunks.
+
+    Chunk scores are grouped by doc_id and aggregated per paper. Chroma is
+    asked for ids, metadata and distances only, starting at a few chunks per
+    wanted paper and doubling until enough distinct papers are found. With
+    mmr_lambda set, papers are diversified by MMR over their best chunk.
+    Documents are fetched last, and only for the snippets that are returned.
+    """
+    total = collection.count()
+    if total == 0 or k <= 0:
+        return []
+
+    space = (getattr(collection, "metadata", None) or {}).get("hnsw:space", "l2")
+    wanted = k * mmr_pool if mmr_lambda is not None else k
+    include = ["metadatas", "distances"] + (["embeddings"] if mmr_lambda is not None else [])
+    n_results = min(initial_fetch or wanted * 4, total, max_fetch)
+
+    while True:
+        results = collection.query(query_embeddings=[np.asarray(query_embedding).tolist()],
+                                   n_results=n_results, where=where, include=include)
+        ids = results["ids"][0]
+        metadatas = results["metadatas"][0]
+        scores = _similarities(results["distances"][0], space)
+
+        papers = {}
+        for index, (chunk_id, metadata) in enumerate(zip(ids, metadatas)):
+            doc_id = (metadata or {}).get("doc_id", chunk_id)
+            papers.setdefault(doc_id, []).append(index)
+
+        # With "max" the ranking is exact once k papers are in: unseen chunks score lower
+        if len(papers) >= wanted or n_results >= min(total, max_fetch):
+            break
+        n_results = min(n_results * 2, total, max_fetch)
+
+    ranked = []
+    for doc_id, indices in papers.items():
+        indices.sort(key=lambda i: scores[i], reverse=True)
+        ranked.append((doc_id, aggregate([float(scores[i]) for i in indices], aggregator, top_n)))
+    ranked.sort(key=lambda item: item[1], reverse=True)
+
+    if mmr_lambda is not None:
+        embeddings = {doc_id: results["embeddings"][0][papers[doc_id][0]] for doc_id, _ in ranked[:wanted]}
+        ranked = mmr(ranked[:wanted], embeddings, k, mmr_lambda)
+    ranked = ranked[:k]
+    if not ranked:
+        return []
+
+    # Payloads only for the snippets we actually return
+    snippet_ids = [ids[i] for doc_id, _ in ranked for i in papers[doc_id][:snippets]]
+    fetched = collection.get(ids=snippet_ids, include=["documents"])
+    documents = dict(zip(fetched["ids"], fetched.get("documents") or [None] * len(fetched["ids"])))
+
+    output = []
+    for doc_id, score in ranked:
+        best = papers[doc_id]
+        output.append({"doc_id": doc_id,
+                       "score": score,
+                       "metadata": metadatas[best[0]] or {},
+                       "num_matches": len(best),
+                       "snippets": [{"id": ids[i],
+                                     "score": float(scores[i]),
+                                     "type": (metadatas[i] or {}).get("type"),
+                                     "document": documents.get(ids[i])}
+                                    for i in best[:snippets]]})
+    return output
@@ -9,29 +9,58 @@ Created on Mon Oct 21 16:56:23 2024
 import sys
 import re
 import os
+import threading
 import pdfplumber
 import chromadb
-from sentence_transformers import SentenceTransformer
 import pandas as pd
 from PyQt5.QtWidgets import (
     QApplication, QWidget, QLabel, QVBoxLayout, QProgressBar,
-    QFileDialog, QDialog, QPushButton, QListWidget, QHBoxLayout
+    QFileDialog, QDialog, QPushButton, QListWidget, QListWidgetItem, QHBoxLayout
 )
 from PyQt5.QtGui import QIcon, QPixmap, QFont
-from PyQt5.QtCore import Qt, QThread, pyqtSignal
+from PyQt5.QtCore import Qt, QObject, QSize, pyqtSignal
+from thumbnails import ThumbnailCache
+from embedding import EmbeddingEngine
+from ralph_service import RalphClient
+from paper_search import query_papers
+from table_store import TableStore
+from doc_index import DocIndex, IndexedCollection, doc_id_for
+from ingest_scheduler import IngestScheduler, PAUSED, DONE
+
+# Use the shared local service when RALPH_SERVICE is set (e.g. 127.0.0.1:8765), so the GUI
+# and batch jobs share one model and one store; otherwise load both in-process
+RALPH_SERVICE = os.environ.get("RALPH_SERVICE")
+if RALPH_SERVICE:
+    client = RalphClient(RALPH_SERVICE)
+    collection = client.get_or_create_collection("research_papers")
+    embedding_engine = client
+else:
+    # Initialize Chroma
+    client = chromadb.Client()
+
+    # Check if collection already exists and use it, otherwise create it
+    try:
+        collection = client.create_collection("research_papers")
+    except chromadb.errors.UniqueConstraintError:
+        collection = client.get_collection("research_papers")
+    # The in-memory store doesn't outlive the process, so neither does its doc_id index
+    collection = IndexedCollection(collection, DocIndex())
+    # Initialize the embedding model; RALPH_EMBEDDING_BACKEND can be torch, int8 or onnx
+    embedding_engine = EmbeddingEngine('all-MiniLM-L6-v2',
+                                       backend=os.environ.get("RALPH_EMBEDDING_BACKEND", "torch"),
+                                       num_threads=int(os.environ.get("RALPH_EMBEDDING_THREADS", 0)) or None)
+
+# Extracted tables are kept column by column, outside Chroma; with the service
+# they live next to its store, so every client resolves the same table_ids
+table_store = client.table_store() if RALPH_SERVICE else TableStore(embedder=embedding_engine)
 
-# Initialize Chroma
-client = chromadb.Client()
+# Extraction runs in parallel; writes to the store and indexes go one at a time
+ingest_lock = threading.Lock()
 
-# Check if collection already exists and use it, otherwise create it
-try:
-    collection = client.create_collection("research_papers")
-except chromadb.errors.UniqueConstraintError:
-    collection = client.get_collection("research_papers")
-# Initialize the embedding model
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# Thumbnails are rendered off the UI thread and cached on disk by content hash
+thumbnail_cache = ThumbnailCache("./thumbnails")
 
-def extract_content_from_pdf(pdf_path):
+def extract_content_from_pdf(pdf_path, checkpoint=None):
     with pdfplumber.open(pdf_path) as pdf:
         text = ""
         figures = []
@@ -39,6 +68,10 @@ def extract_content_from_pdf(pdf_path):
         title, authors, year, journal = None, None, None, None
 
         for page_num, page in enumerate(pdf.pages):
+            # Lets the ingest scheduler pause or cancel between pages
+            if checkpoint:
+                checkpoint()
+
             # Extract text
             page_text = page.extract_text()
             if page_text:
@@ -77,6 +110,7 @@ def extract_content_from_pdf(pdf_path):
             if table_data:
                 for table in table_data:
                     df = pd.DataFrame(table)
+                    df.attrs["page"] = page_num + 1  # 1-based, as PDF_Parsing_TEst.py stores it
                     tables.append(df)
 
     if not authors:
@@ -124,53 +158,58 @@ def generate_citation(authors, title, journal, year):
 
 # Create embeddings for text
 def create_embeddings(text):
-    return model.encode([text])[0]
+    return embedding_engine.encode(text)
 
 def add_to_chroma_with_metadata(collection, doc_id, text, figures, tables, file_path, citation):
-    # Add main text embedding
-    text_embedding = create_embeddings(text)
-    collection.add(
-        ids=[f"{doc_id}_text"],
-        embeddings=[text_embedding],
-        metadatas=[{
-            "type": "text",
-            "content": text,
+    # The chunk text goes in documents; metadata stays small, since queries
+    # return it for every over-fetched hit
+    ids, contents, metadatas = [], [], []
+
+    # Main text with file path and citation
+    ids.append(f"{doc_id}_text")
+    contents.append(text)
+    metadatas.append({
+        "type": "text",
+        "file_path": file_path,
+        "citation": citation,
+        "doc_id": doc_id
+    })
+
+    # Figure captions with file path and citation
+    for idx, figure in enumerate(figures):
+        caption = figure['caption']
+        ids.append(f"{doc_id}_figure_{idx}")
+        contents.append(caption)
+        metadatas.append({
+            "type": "figure",
             "file_path": file_path,
             "citation": citation,
             "doc_id": doc_id
-        }]
-    )
+        })
+
+    # Tables go to the columnar store; Chroma only indexes their headers
+    table_ids = table_store.add_tables(doc_id, tables, pages=[table.attrs.get("page") for table in tables])
+    for table_id in table_ids:
+        columns = ", ".join(table_store.columns(table_id))
+        ids.append(table_id)
+        contents.append(f"Table: {columns}")
+        metadatas.append({
+            "type": "table",
+            "table_id": table_id,
+            "columns": columns,
+            "file_path": file_path,
+            "citation": citation,
+            "doc_id": doc_id
+        })
 
-    # Add figure captions with file path and citation
-    for idx, figure in enumerate(figures):
-        caption = figure['caption']
-        caption_embedding = create_embeddings(caption)
-        collection.add(
-            ids=[f"{doc_id}_figure_{idx}"],
-            embeddings=[caption_embedding],
-            metadatas=[{
-                "type": "figure",
-                "caption": caption,
-                "file_path": file_path,
-                "citation": citation,
-                "doc_id": doc_id
-            }]
-        )
-
-    # Add table embeddings with file path and citation
-    for idx, table in enumerate(tables):
-        table_embedding = create_embeddings(table.to_string())
-        collection.add(
-            ids=[f"{doc_id}_table_{idx}"],
-            embeddings=[table_embedding],
-            metadatas=[{
-                "type": "table",
-                "content": table.to_string(),
-                "file_path": file_path,
-                "citation": citation,
-                "doc_id": doc_id
-            }]
-        )
+    # One bucketed encode and one upsert for the whole paper; a re-upload replaces it
+    embeddings = embedding_engine.encode(contents)
+    collection.upsert_document(doc_id, ids, embeddings.tolist(), metadatas, documents=contents)
+
+# Remove one paper via the doc_id index, leaving the rest of the library alone
+def delete_from_chroma(collection, doc_id):
+    collection.delete_document(doc_id)
+    table_store.delete_document(doc_id)
 
 # Query Chroma for relevant documents
 def query_chroma(query, collection, num_results=5):
@@ -181,59 +220,132 @@ def query_chroma(query, collection, num_results=5):
     )
     return results['ids'], results['metadatas']
 
-# Multithreaded processing of PDFs
-class FileProcessingThread(QThread):
-    progress = pyqtSignal(int)
-    finished = pyqtSignal()
-
-    def __init__(self, file_paths, collection):
-        super().__init__()
-        self.file_paths = file_paths
-        self.collection = collection
-
-    def run(self):
-        for index, pdf_path in enumerate(self.file_paths):
-            print(f"Processing file: {pdf_path}")
-            text, figures, tables, title, authors, year, journal = extract_content_from_pdf(pdf_path)
-            citation = generate_citation(authors, title, journal, year)
-            doc_id = os.path.basename(pdf_path).split('.')[0]
-            add_to_chroma_with_metadata(self.collection, doc_id, text, figures, tables, pdf_path, citation)
-
-            self.progress.emit(index + 1)
-        self.finished.emit()
+# Query Chroma for the top papers, aggregating chunk scores per doc_id
+def query_chroma_papers(query, collection, num_results=10, aggregator="max", mmr_lambda=None):
+    query_embedding = create_embeddings(query)
+    return query_papers(collection, query_embedding, k=num_results,
+                        aggregator=aggregator, mmr_lambda=mmr_lambda)
+
+# Processing of one PDF, run by the ingest scheduler's worker pool
+def process_file(pdf_path, checkpoint=None):
+    print(f"Processing file: {pdf_path}")
+    text, figures, tables, title, authors, year, journal = extract_content_from_pdf(pdf_path, checkpoint)
+    citation = generate_citation(authors, title, journal, year)
+    doc_id = doc_id_for(pdf_path)
+
+    # Last chance to cancel before anything is written
+    if checkpoint:
+        checkpoint()
+    with ingest_lock:
+        add_to_chroma_with_metadata(collection, doc_id, text, figures, tables, doc_id, citation)
+    thumbnail_cache.prefetch(doc_id)
 
 # PyQt GUI
 class ProgressDialog(QDialog):
-    def __init__(self, total_files):
+    def __init__(self, scheduler):
         super().__init__()
-        self.total_files = total_files
+        self.scheduler = scheduler
+        self.job_items = {}
         self.init_ui()
 
+        self.scheduler.job_added.connect(self.add_job)
+        self.scheduler.job_state.connect(self.update_job)
+        self.scheduler.queue_changed.connect(self.update_progress)
+
     def init_ui(self):
         self.setWindowTitle('Loading Documents')
-        self.setFixedSize(400, 100)
-        self.setWindowModality(Qt.ApplicationModal)
+        self.resize(500, 300)
+        self.setWindowModality(Qt.NonModal)
 
-        self.label = QLabel('Loading documents, please wait...', self)
+        self.label = QLabel('Loading documents, smallest first...', self)
         self.label.setAlignment(Qt.AlignCenter)
 
         self.progress_bar = QProgressBar(self)
         self.progress_bar.setAlignment(Qt.AlignCenter)
         self.progress_bar.setMinimum(0)
-        self.progress_bar.setMaximum(self.total_files)
+        self.progress_bar.setMaximum(0)
         self.progress_bar.setValue(0)
 
+        self.job_list_widget = QListWidget(self)
+
+        pause_button = QPushButton('Pause / Resume', self)
+        pause_button.clicked.connect(self.toggle_pause_selected)
+        cancel_button = QPushButton('Cancel', self)
+        cancel_button.clicked.connect(self.cancel_selected)
+        cancel_all_button = QPushButton('Cancel All', self)
+        cancel_all_button.clicked.connect(self.scheduler.cancel_all)
+
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(pause_button)
+        button_layout.addWidget(cancel_button)
+        button_layout.addWidget(cancel_all_button)
+
         layout = QVBoxLayout()
         layout.addWidget(self.label)
         layout.addWidget(self.progress_bar)
+        layout.addWidget(self.job_list_widget)
+        layout.addLayout(button_layout)
         self.setLayout(layout)
 
-    def update_progress(self, value):
-        self.progress_bar.setValue(value)
+    def add_job(self, job_id, file_path):
+        item = QListWidgetItem(f"[queued] {os.path.basename(file_path)}")
+        item.setData(Qt.UserRole, job_id)
+        self.job_list_widget.addItem(item)
+        self.job_items[job_id] = item
+        self.show()
+
+    def update_job(self, job_id, state):
+        item = self.job_items.get(job_id)
+        if item is not None:
+            item.setText(f"[{state}] {os.path.basename(self.scheduler.jobs[job_id].path)}")
+
+    def selected_job_ids(self):
+        return [item.data(Qt.UserRole) for item in self.job_list_widget.selectedItems()]
+
+    def toggle_pause_selected(self):
+        for job_id in self.selected_job_ids():
+            # A running job shown as pausing can still be resumed before it stops
+            job = self.scheduler.jobs[job_id]
+            if job.state == PAUSED or job.pausing:
+                self.scheduler.resume(job_id)
+            else:
+                self.scheduler.pause(job_id)
+
+    def cancel_selected(self):
+        for job_id in self.selected_job_ids():
+            self.scheduler.cancel(job_id)
+
+    def update_progress(self, finished, total):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(finished)
+        if total and finished == total:
+            self.job_list_widget.clear()
+            self.job_items = {}
+            self.accept()
+
+# Carries thumbnails from the render pool back to the UI thread
+class ThumbnailLoader(QObject):
+    loaded = pyqtSignal(str, bytes)
+
+    def request(self, file_path):
+        thumbnail_cache.request(file_path, self._on_rendered)
+
+    def _on_rendered(self, file_path, png):
+        if png:
+            self.loaded.emit(file_path, png)
 
 class ReferenceManager(QWidget):
     def __init__(self):
         super().__init__()
+        self.file_items = {}
+        self.requested_thumbnails = set()
+        self.thumbnail_loader = ThumbnailLoader()
+        self.thumbnail_loader.loaded.connect(self.set_thumbnail)
+
+        # One scheduler and worker pool for every upload, cheapest papers first
+        self.scheduler = IngestScheduler(process_file, workers=2)
+        self.scheduler.job_state.connect(self.on_job_state)
+        self.progress_dialog = ProgressDialog(self.scheduler)
         self.init_ui()
 
     def init_ui(self):
@@ -257,6 +369,9 @@ class ReferenceManager(QWidget):
         upload_button.clicked.connect(self.upload_pdf)
 
         self.file_list_widget = QListWidget(self)
+        self.file_list_widget.setIconSize(QSize(48, 48))
+        self.file_list_widget.setUniformItemSizes(True)
+        self.file_list_widget.verticalScrollBar().valueChanged.connect(self.request_visible_thumbnails)
         self.update_file_list()
 
         main_layout = QVBoxLayout()
@@ -278,23 +393,25 @@ class ReferenceManager(QWidget):
             self.process_files(file_paths)
 
     def process_files(self, file_paths):
-        total_files = len(file_paths)
-        if total_files == 0:
+        if len(file_paths) == 0:
             return
+        self.scheduler.submit(file_paths)
 
-        progress_dialog = ProgressDialog(total_files)
-        progress_dialog.show()
-
-        collection = client.get_or_create_collection("research_papers")
-        self.worker_thread = FileProcessingThread(file_paths, collection)
-
-        self.worker_thread.progress.connect(progress_dialog.update_progress)
-        self.worker_thread.finished.connect(progress_dialog.accept)
-        self.worker_thread.finished.connect(self.update_file_list)
-        self.worker_thread.start()
+    def on_job_state(self, job_id, state):
+        # Each paper shows up as soon as it is searchable, not when the whole upload is done
+        if state != DONE:
+            return
+        file_path = doc_id_for(self.scheduler.jobs[job_id].path)
+        if file_path not in self.file_items:
+            item = QListWidgetItem(file_path)
+            self.file_list_widget.addItem(item)
+            self.file_items[file_path] = item
+            self.request_visible_thumbnails()
 
     def update_file_list(self):
         self.file_list_widget.clear()
+        self.file_items = {}
+        self.requested_thumbnails = set()
         collection = client.get_collection("research_papers")
         unique_file_paths = set()
         all_documents = collection.get(ids=None)
@@ -306,7 +423,49 @@ class ReferenceManager(QWidget):
                     unique_file_paths.add(file_path)
 
         for file_path in unique_file_paths:
-            self.file_list_widget.addItem(file_path)
+            item = QListWidgetItem(file_path)
+            self.file_list_widget.addItem(item)
+            self.file_items[file_path] = item
+
+        self.request_visible_thumbnails()
+
+    def request_visible_thumbnails(self, *args):
+        # Only the rows on screen get thumbnails, so long lists scroll smoothly
+        viewport = self.file_list_widget.viewport()
+        first = self.file_list_widget.indexAt(viewport.rect().topLeft()).row()
+        last = self.file_list_widget.indexAt(viewport.rect().bottomLeft()).row()
+        if first < 0:
+            return
+        if last < 0:
+            last = self.file_list_widget.count() - 1
+
+        for row in range(first, last + 1):
+            file_path = self.file_list_widget.item(row).text()
+            if file_path in self.requested_thumbnails:
+                continue
+            self.requested_thumbnails.add(file_path)
+            png = thumbnail_cache.get(file_path)
+            if png:
+                self.set_thumbnail(file_path, png)
+            else:
+                self.thumbnail_loader.request(file_path)
+
+    def set_thumbnail(self, file_path, png):
+        item = self.file_items.get(file_path)
+        if item is None:
+            return
+        pixmap = QPixmap()
+        pixmap.loadFromData(png, "PNG")
+        item.setIcon(QIcon(pixmap))
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        self.request_visible_thumbnails()
+
+    def closeEvent(self, event):
+        self.scheduler.shutdown()
+        thumbnail_cache.shutdown()
+        super().closeEvent(event)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
@@ -321,6 +480,9 @@ if __name__ == '__main__':
 
 #%%
 
+# # Remove or re-index a single paper without rebuilding the library
+# delete_from_chroma(collection, doc_id)
+
 # # Initialize Chroma
 # client = chromadb.Client()
 
@@ -0,0 +1,434 @@
+"""
+Local embedding/search service. One process owns the SentenceTransformer and
+the Chroma store; the GUI, batch imports and analysis scripts talk to it over
+localhost HTTP instead of each loading their own copy.
+
+    python ralph_service.py --address 127.0.0.1:8765 --db ./db --backend int8
+
+Clients use RalphClient, which mirrors the parts of the chromadb client API
+the rest of Ralph uses, so it can be dropped in where a chromadb client was.
+
+Every request must carry the service token, taken from RALPH_SERVICE_TOKEN or
+from <db>/service_token, which the service creates on first start. Requests
+from browsers (with an Origin header) or not sent as JSON are refused.
+"""
+
+import os
+import sys
+import json
+import hmac
+import queue
+import secrets
+import threading
+import http.client
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from doc_index import DocIndex, IndexedCollection
+from table_store import TableStore
+
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+TOKEN_HEADER = "X-Ralph-Token"
+
+# Collection methods clients are allowed to call through the service. Writes go
+# through upsert_document/delete_document only, so the doc_id index stays in step
+COLLECTION_METHODS = ("get", "query", "count", "upsert_document", "delete_document")
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class ServiceError(Exception):
+    pass
+
+
+def load_token(db_path="./db", create=False):
+    """
+    The shared secret for the service: RALPH_SERVICE_TOKEN if set, otherwise
+    the contents of <db_path>/service_token. With create, a missing token file
+    is written with a new random token, readable only by the user.
+    """
+    token = os.environ.get("RALPH_SERVICE_TOKEN")
+    if token:
+        return token
+    token_path = os.path.join(db_path, "service_token")
+    if os.path.exists(token_path):
+        with open(token_path) as f:
+            return f.read().strip()
+    if not create:
+        raise ServiceError(f"No service token: set RALPH_SERVICE_TOKEN or start the service on {db_path}")
+    os.makedirs(db_path, exist_ok=True)
+    token = secrets.token_hex(32)
+    fd = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+def _frame_to_json(df):
+    # Raw extracted tables keep integer column labels, which normalize_table relies on
+    columns = None if all(isinstance(c, (int, np.integer)) for c in df.columns) else [str(c) for c in df.columns]
+    return {"columns": columns, "data": df.astype(object).where(df.notna(), None).values.tolist()}
+
+
+def _frame_from_json(frame):
+    import pandas as pd
+    if frame["columns"] is None:
+        return pd.DataFrame(frame["data"])
+    return pd.DataFrame(frame["data"], columns=frame["columns"])
+
+
+#%% Server
+
+class EncodeBatcher(threading.Thread):
+    """
+    Collects encode requests from every connected client for up to max_wait
+    seconds and runs them through the model as one bucketed batch.
+    """
+
+    def __init__(self, engine, max_wait=0.005, max_texts=512):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.max_wait = max_wait
+        self.max_texts = max_texts
+        self.requests = queue.Queue()
+
+    def submit(self, texts):
+        future = Future()
+        self.requests.put((texts, future))
+        return future
+
+    def encode(self, texts):
+        # Lets server-side users such as the table store share the batches
+        single = isinstance(texts, str)
+        embeddings = self.submit([texts] if single else texts).result()
+        return embeddings[0] if single else embeddings
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            total = len(batch[0][0])
+            while total < self.max_texts:
+                try:
+                    item = self.requests.get(timeout=self.max_wait)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                total += len(item[0])
+
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                embeddings = self.engine.encode(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            start = 0
+            for item_texts, future in batch:
+                future.set_result(embeddings[start:start + len(item_texts)])
+                start += len(item_texts)
+
+
+class RalphService:
+    def __init__(self, db_path="./db", model_name='all-MiniLM-L6-v2', backend="torch", num_threads=None):
+        import chromadb
+        from embedding import EmbeddingEngine
+
+        self.db_path = db_path
+        self.token = load_token(db_path, create=True)
+        self.client = chromadb.PersistentClient(path=db_path)
+        self.engine = EmbeddingEngine(model_name, backend=backend, num_threads=num_threads)
+        self.batcher = EncodeBatcher(self.engine)
+        self.batcher.start()
+
+        # Chroma calls are serialized; encoding is where the concurrency pays off
+        self.store_lock = threading.Lock()
+        self.collections = {}
+
+        # Tables live with the store, so table_ids in Chroma resolve for every client
+        self.tables = TableStore(os.path.join(db_path, "tables"), self.batcher)
+        self.tables_lock = threading.Lock()
+        return
+
+    def _handle_tables(self, method, payload):
+        with self.tables_lock:
+            if method == "add_tables":
+                tables = [_frame_from_json(frame) for frame in payload.pop("tables")]
+                return {"result": self.tables.add_tables(tables=tables, **payload)}
+            if method == "load":
+                return {"result": _frame_to_json(self.tables.load(**payload))}
+            if method in ("delete_document", "columns", "search_headers", "filter_numeric"):
+                return {"result": getattr(self.tables, method)(**payload)}
+        raise ServiceError(f"Unknown table method {method}")
+
+    def _collection(self, name):
+        if name not in self.collections:
+            index = DocIndex(os.path.join(self.db_path, f"doc_index_{name}.jsonl"))
+            self.collections[name] = IndexedCollection(self.client.get_or_create_collection(name), index)
+        return self.collections[name]
+
+    def handle(self, path, payload):
+        parts = [part for part in path.split("/") if part]
+
+        if parts == ["encode"]:
+            return {"embeddings": self.batcher.submit(payload["texts"]).result()}
+
+        if len(parts) == 2 and parts[0] == "tables":
+            return self._handle_tables(parts[1], payload)
+
+        if parts == ["collections"]:
+            with self.store_lock:
+                return {"collections": [getattr(c, "name", c) for c in self.client.list_collections()]}
+
+        if len(parts) == 3 and parts[0] == "collections":
+            name, method = parts[1], parts[2]
+            with self.store_lock:
+                if method == "get_or_create":
+                    self._collection(name)
+                    return {"name": name}
+                if method == "drop":
+                    self.collections.pop(name, None)
+                    self.client.delete_collection(name)
+                    index_path = os.path.join(self.db_path, f"doc_index_{name}.jsonl")
+                    if os.path.exists(index_path):
+                        os.remove(index_path)
+                    return {"name": name}
+                if method == "metadata":
+                    # Lets clients see the distance space, which query scores depend on
+                    return {"result": self._collection(name).metadata}
+                if method in COLLECTION_METHODS:
+                    return {"result": getattr(self._collection(name), method)(**payload)}
+
+        raise ServiceError(f"Unknown endpoint {path}")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so pooled client connections are reused
+
+    def _refuse(self, status, error):
+        data = json.dumps({"ok": False, "error": error}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+        self.close_connection = True
+
+    def do_POST(self):
+        # Web pages can reach localhost too; only accept JSON from our own clients
+        if self.headers.get("Origin") is not None:
+            return self._refuse(403, "Cross-origin requests are not accepted")
+        if self.headers.get_content_type() != "application/json":
+            return self._refuse(415, "Requests must be application/json")
+        token = self.headers.get(TOKEN_HEADER, "")
+        if not hmac.compare_digest(token.encode("utf-8"), self.server.service.token.encode("utf-8")):
+            return self._refuse(401, "Missing or wrong service token")
+
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            body = {"ok": True, **self.server.service.handle(self.path, payload)}
+            status = 200
+        except Exception as e:
+            body = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            status = 400 if isinstance(e, (ServiceError, KeyError, TypeError, ValueError)) else 500
+
+        data = json.dumps(body, default=_to_json).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        return
+
+
+def serve(address=DEFAULT_ADDRESS, **service_kwargs):
+    host, port = address.rsplit(":", 1)
+    server = ThreadingHTTPServer((host, int(port)), _Handler)
+    server.daemon_threads = True
+    server.service = RalphService(**service_kwargs)
+    print(f"Ralph service listening on {host}:{port}")
+    server.serve_forever()
+
+
+#%% Client
+
+class RemoteCollection:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        # Fixed when the collection is created, so fetched once
+        if self._metadata is None:
+            self._metadata = self._call("metadata") or {}
+        return self._metadata
+
+    def _call(self, method, **kwargs):
+        kwargs = {key: value for key, value in kwargs.items() if value is not None}
+        return self.client._post(f"/collections/{self.name}/{method}", kwargs)["result"]
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=None):
+        return self._call("get", ids=ids, where=where, limit=limit, offset=offset, include=include)
+
+    def query(self, query_embeddings, n_results=10, where=None, include=None):
+        return self._call("query", query_embeddings=query_embeddings, n_results=n_results,
+                          where=where, include=include)
+
+    def count(self):
+        return self._call("count")
+
+    def upsert_document(self, doc_id, ids, embeddings, metadatas=None, documents=None):
+        return self._call("upsert_document", doc_id=doc_id, ids=ids, embeddings=embeddings,
+                          metadatas=metadatas, documents=documents)
+
+    def delete_document(self, doc_id):
+        return self._call("delete_document", doc_id=doc_id)
+
+
+class RemoteTableStore:
+    """
+    The service's TableStore, with the same calls Ralph makes on a local one.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def _call(self, method, **kwargs):
+        kwargs = {key: value for key, value in kwargs.items() if value is not None}
+        return self.client._post(f"/tables/{method}", kwargs)["result"]
+
+    def add_tables(self, doc_id, tables, pages=None, captions=None):
+        return self._call("add_tables", doc_id=doc_id, tables=[_frame_to_json(table) for table in tables],
+                          pages=pages, captions=captions)
+
+    def delete_document(self, doc_id):
+        return self._call("delete_document", doc_id=doc_id)
+
+    def columns(self, table_id):
+        return self._call("columns", table_id=table_id)
+
+    def load(self, table_id, columns=None):
+        return _frame_from_json(self._call("load", table_id=table_id, columns=columns))
+
+    def search_headers(self, query, k=10):
+        query = query if isinstance(query, str) else np.asarray(query, dtype=np.float32).tolist()
+        return [tuple(match) for match in self._call("search_headers", query=query, k=k)]
+
+    def filter_numeric(self, column, min_value=None, max_value=None, table_ids=None):
+        return self._call("filter_numeric", column=column, min_value=min_value,
+                          max_value=max_value, table_ids=table_ids)
+
+
+class RalphClient:
+    """
+    Connection-pooled client for RalphService. Also exposes encode(), so it can
+    stand in for an EmbeddingEngine as well as for a chromadb client.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, pool_size=4, timeout=300, token=None, db_path="./db"):
+        self.host, port = address.rsplit(":", 1)
+        self.port = int(port)
+        self.timeout = timeout
+        self.token = token or load_token(db_path)
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connection(self):
+        # Returns (connection, reused) so callers know whether it may have gone stale
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _post(self, path, payload):
+        data = json.dumps(payload, default=_to_json).encode("utf-8")
+        headers = {"Content-Type": "application/json", TOKEN_HEADER: self.token}
+
+        while True:
+            connection, reused = self._connection()
+            try:
+                connection.request("POST", path, body=data, headers=headers)
+                response = connection.getresponse()
+            except (BrokenPipeError, ConnectionResetError, http.client.RemoteDisconnected):
+                # An idle pooled connection the server already closed: the request was
+                # never read, so it is safe to resend on another connection
+                connection.close()
+                if reused:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+
+            # Timeouts and failures once the response has started are never retried,
+            # since the call may already have run (add, delete_document, encode)
+            try:
+                body = json.loads(response.read())
+            except Exception:
+                connection.close()
+                raise
+            self._release(connection)
+            if not body.get("ok"):
+                raise ServiceError(body.get("error", "Unknown service error"))
+            return body
+
+    def encode(self, texts):
+        single = isinstance(texts, str)
+        embeddings = np.asarray(self._post("/encode", {"texts": [texts] if single else texts})["embeddings"],
+                                dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+    def get_or_create_collection(self, name):
+        self._post(f"/collections/{name}/get_or_create", {})
+        return RemoteCollection(self, name)
+
+    def get_collection(self, name):
+        return RemoteCollection(self, name)
+
+    def table_store(self):
+        return RemoteTableStore(self)
+
+    def delete_collection(self, name):
+        self._post(f"/collections/{name}/drop", {})
+
+    def list_collections(self):
+        return self._post("/collections", {})["collections"]
+
+    def ping(self):
+        try:
+            self.list_collections()
+            return True
+        except (ServiceError, OSError, http.client.HTTPException):
+            return False
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ralph local embedding/search service")
+    parser.add_argument("--address", default=os.environ.get("RALPH_SERVICE", DEFAULT_ADDRESS))
+    parser.add_argument("--db", default="./db")
+    parser.add_argument("--backend", default="torch")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args(sys.argv[1:])
+
+    serve(args.address, db_path=args.db, backend=args.backend, num_threads=args.threads)
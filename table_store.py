@@ -0,0 +1,325 @@
+"""
+Columnar storage and header search for extracted tables.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+# The one place tables live, for the GUI, batch imports and ralph_service alike
+DEFAULT_ROOT = "./db/tables"
+
+try:
+    import pyarrow  # noqa: F401  Parquet support for pandas
+    HAS_PARQUET = True
+except ImportError:
+    HAS_PARQUET = False
+
+
+def normalize_table(df):
+    """
+    Turns a raw extracted table (every cell a string, header in the first row)
+    into a DataFrame with unique column names and all-numeric columns as floats.
+    """
+    df = df.copy()
+    first_row = [str(cell).strip() if cell is not None else "" for cell in df.iloc[0]] if len(df) else []
+    numeric_header = sum(pd.to_numeric(pd.Series(first_row), errors="coerce").notna()) > len(first_row) / 2
+    if first_row and any(first_row) and not numeric_header and all(isinstance(c, int) for c in df.columns):
+        df.columns = first_row
+        df = df.iloc[1:].reset_index(drop=True)
+
+    names, seen = [], {}
+    for i, column in enumerate(df.columns):
+        name = " ".join(str(column).split()) if column is not None and str(column).strip() else f"col_{i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}_{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    df.columns = names
+
+    for column in df.columns:
+        values = df[column].mask(df[column].isna() | (df[column].astype(str).str.strip() == ""))
+        numeric = pd.to_numeric(values.astype(str).str.replace(",", "", regex=False), errors="coerce")
+        # The store is the only copy of the table, so a column becomes numeric
+        # only when no cell would be lost; "n/a" or "see note" keeps it as text
+        if values.notna().sum() and numeric.notna().sum() == values.notna().sum():
+            df[column] = numeric.astype(np.float64)
+        else:
+            df[column] = values.fillna("").astype(str)
+    return df
+
+
+class TableStore:
+    """
+    Extracted tables stored column by column, one directory per table, as
+    Parquet when pyarrow is installed and memory-mapped .npy columns otherwise.
+
+    A catalog keeps each table's schema with per-column min/max, so numeric
+    range filters skip tables without opening them, and a header index holds
+    one embedding per column name for table-aware search.
+
+    Both are append-only logs, like DocIndex: ingesting a paper writes only
+    that paper's entries, and the logs are compacted once mostly superseded.
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, embedder=None, use_parquet=None):
+        self.root = root
+        self.embedder = embedder
+        self.use_parquet = HAS_PARQUET if use_parquet is None else use_parquet
+        os.makedirs(self.root, exist_ok=True)
+
+        # Catalog log: {"table_id": ..., "entry": {...}}, or "entry": null once dropped
+        self.catalog_path = os.path.join(self.root, "catalog.jsonl")
+        self.catalog = {}
+        self._catalog_lines = 0
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if record["entry"] is None:
+                        self.catalog.pop(record["table_id"], None)
+                    else:
+                        self.catalog[record["table_id"]] = record["entry"]
+                    self._catalog_lines += 1
+
+        # Header index: row i of headers.f32 belongs to header_keys[i] = [table_id, column].
+        # The log starts with {"dim": ...} once anything is embedded. Rows of
+        # dropped tables stay in the files and are masked until compaction
+        self.keys_path = os.path.join(self.root, "headers.jsonl")
+        self.embeddings_path = os.path.join(self.root, "headers.f32")
+        self.header_keys = []
+        self._dim = None
+        self._dead = set()
+        self._blocks = []
+        dim = None
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    if "dim" in record:
+                        dim = record["dim"]
+                    elif "drop" in record:
+                        dropped = set(record["drop"])
+                        self._dead.update(i for i, (table_id, _) in enumerate(self.header_keys) if table_id in dropped)
+                    else:
+                        self.header_keys.append(record["key"])
+        raw = np.fromfile(self.embeddings_path, dtype=np.float32) if os.path.exists(self.embeddings_path) else np.zeros(0, np.float32)
+        rows = len(self.header_keys)
+        if dim and raw.size == rows * dim:
+            self._dim = dim
+            self._blocks = [raw.reshape(rows, dim)] if rows else []
+        elif rows or raw.size:
+            # An interrupted write left keys and rows out of step; the mapping can't be trusted
+            print(f"Header index in {self.root} is inconsistent, discarding it")
+            self.header_keys, self._dead = [], set()
+            self._compact_headers()
+
+        if self._catalog_lines > 2 * len(self.catalog) + 100:
+            self._compact_catalog()
+        if len(self._dead) > len(self.header_keys) - len(self._dead) + 1000:
+            self._compact_headers()
+        return
+
+    @property
+    def header_embeddings(self):
+        # Blocks are appended per paper and only concatenated when searched
+        if len(self._blocks) > 1:
+            self._blocks = [np.vstack(self._blocks)]
+        return self._blocks[0] if self._blocks else None
+
+    def _log_catalog(self, records):
+        with open(self.catalog_path, "a") as f:
+            for table_id, entry in records:
+                f.write(json.dumps({"table_id": table_id, "entry": entry}) + "\n")
+        self._catalog_lines += len(records)
+        if self._catalog_lines > 2 * len(self.catalog) + 100:
+            self._compact_catalog()
+        return
+
+    def _compact_catalog(self):
+        with open(self.catalog_path + ".tmp", "w") as f:
+            for table_id, entry in self.catalog.items():
+                f.write(json.dumps({"table_id": table_id, "entry": entry}) + "\n")
+        os.replace(self.catalog_path + ".tmp", self.catalog_path)
+        self._catalog_lines = len(self.catalog)
+        return
+
+    def _compact_headers(self):
+        live = [i for i in range(len(self.header_keys)) if i not in self._dead]
+        embeddings = self.header_embeddings
+        with open(self.keys_path + ".tmp", "w") as f:
+            if self._dim:
+                f.write(json.dumps({"dim": self._dim}) + "\n")
+            for i in live:
+                f.write(json.dumps({"key": self.header_keys[i]}) + "\n")
+        if embeddings is not None and live:
+            embeddings = np.ascontiguousarray(embeddings[live], dtype=np.float32)
+            embeddings.tofile(self.embeddings_path + ".tmp")
+            self._blocks = [embeddings]
+        else:
+            open(self.embeddings_path + ".tmp", "wb").close()
+            self._blocks = []
+        os.replace(self.embeddings_path + ".tmp", self.embeddings_path)
+        os.replace(self.keys_path + ".tmp", self.keys_path)
+        self.header_keys = [self.header_keys[i] for i in live]
+        self._dead = set()
+        return
+
+    def _table_dir(self, table_id):
+        # doc_ids can be full file paths, so directories are named by hash
+        return os.path.join(self.root, hashlib.sha1(table_id.encode("utf-8")).hexdigest())
+
+    def _write_columns(self, table_id, df):
+        table_dir = self._table_dir(table_id)
+        shutil.rmtree(table_dir, ignore_errors=True)
+        os.makedirs(table_dir)
+        if self.use_parquet:
+            df.to_parquet(os.path.join(table_dir, "table.parquet"), index=False)
+            return "parquet"
+        for i, column in enumerate(df.columns):
+            values = df[column].to_numpy(dtype=np.float64) if df[column].dtype.kind == "f" \
+                else df[column].to_numpy(dtype=str)
+            np.save(os.path.join(table_dir, f"{i}.npy"), values)
+        return "npy"
+
+    def _header_text(self, column, caption):
+        return f"{column} ({caption})" if caption else column
+
+    def add_tables(self, doc_id, tables, pages=None, captions=None):
+        """
+        Stores every table of one paper and indexes its headers. Tables are raw
+        DataFrames as extracted; returns the table ids in input order.
+        """
+        self.delete_document(doc_id)
+        if not len(tables):
+            return []
+
+        table_ids, header_keys, header_texts, records = [], [], [], []
+        for idx, table in enumerate(tables):
+            table_id = f"{doc_id}_table_{idx}"
+            df = normalize_table(table)
+            caption = captions[idx] if captions else None
+
+            columns = []
+            for column in df.columns:
+                entry = {"name": column, "dtype": "float" if df[column].dtype.kind == "f" else "str"}
+                if entry["dtype"] == "float" and df[column].notna().any():
+                    entry["min"] = float(df[column].min())
+                    entry["max"] = float(df[column].max())
+                columns.append(entry)
+                header_keys.append([table_id, column])
+                header_texts.append(self._header_text(column, caption))
+
+            self.catalog[table_id] = {"doc_id": doc_id,
+                                      "page": pages[idx] if pages else None,
+                                      "caption": caption,
+                                      "num_rows": len(df),
+                                      "columns": columns,
+                                      "format": self._write_columns(table_id, df)}
+            records.append((table_id, self.catalog[table_id]))
+            table_ids.append(table_id)
+        self._log_catalog(records)
+
+        if header_texts and self.embedder is not None:
+            embeddings = np.asarray(self.embedder.encode(header_texts), dtype=np.float32)
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+
+            # Keys only go in alongside their embeddings, so row i always belongs to key i
+            with open(self.embeddings_path, "ab") as f:
+                np.ascontiguousarray(embeddings).tofile(f)
+            with open(self.keys_path, "a") as f:
+                if self._dim is None:
+                    self._dim = embeddings.shape[1]
+                    f.write(json.dumps({"dim": self._dim}) + "\n")
+                for key in header_keys:
+                    f.write(json.dumps({"key": key}) + "\n")
+            self._blocks.append(embeddings)
+            self.header_keys.extend(header_keys)
+        return table_ids
+
+    def delete_document(self, doc_id):
+        table_ids = [table_id for table_id, entry in self.catalog.items() if entry["doc_id"] == doc_id]
+        if not table_ids:
+            return
+        for table_id in table_ids:
+            self.catalog.pop(table_id)
+            shutil.rmtree(self._table_dir(table_id), ignore_errors=True)
+        self._log_catalog([(table_id, None) for table_id in table_ids])
+
+        dropped = set(table_ids)
+        dead = {i for i, (table_id, _) in enumerate(self.header_keys) if table_id in dropped and i not in self._dead}
+        if dead:
+            with open(self.keys_path, "a") as f:
+                f.write(json.dumps({"drop": table_ids}) + "\n")
+            self._dead.update(dead)
+            if len(self._dead) > len(self.header_keys) - len(self._dead) + 1000:
+                self._compact_headers()
+        return
+
+    def columns(self, table_id):
+        return [column["name"] for column in self.catalog[table_id]["columns"]]
+
+    def load(self, table_id, columns=None):
+        """
+        Loads a table, or only the named columns. The .npy layout is memory
+        mapped, so reading one column of a large table touches only that file.
+        """
+        entry = self.catalog[table_id]
+        names = [column["name"] for column in entry["columns"]]
+        columns = columns or names
+        table_dir = self._table_dir(table_id)
+        if entry["format"] == "parquet":
+            return pd.read_parquet(os.path.join(table_dir, "table.parquet"), columns=columns)
+        return pd.DataFrame({column: np.load(os.path.join(table_dir, f"{names.index(column)}.npy"), mmap_mode="r")
+                             for column in columns})
+
+    def search_headers(self, query, k=10):
+        """
+        Finds the columns whose header best matches query (a string or an
+        embedding). Returns [(table_id, column, score)], best first.
+        """
+        embeddings = self.header_embeddings
+        if embeddings is None or not embeddings.size:
+            return []
+        query_embedding = self.embedder.encode(query) if isinstance(query, str) else query
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        query_embedding /= max(np.linalg.norm(query_embedding), 1e-12)
+
+        scores = embeddings @ query_embedding
+        if self._dead:
+            scores[list(self._dead)] = -np.inf
+        best = [i for i in np.argsort(-scores)[:k] if i not in self._dead]
+        return [(self.header_keys[i][0], self.header_keys[i][1], float(scores[i])) for i in best]
+
+    def filter_numeric(self, column, min_value=None, max_value=None, table_ids=None):
+        """
+        Rows where a numeric column named like column (case-insensitive
+        substring) lies in [min_value, max_value]. Tables whose catalog min/max
+        can't overlap the range are skipped without reading them.
+        Returns [{"table_id", "column", "rows"}] with matching row indices.
+        """
+        needle = column.lower()
+        low = -np.inf if min_value is None else min_value
+        high = np.inf if max_value is None else max_value
+
+        matches = []
+        for table_id in (table_ids or self.catalog.keys()):
+            for entry in self.catalog[table_id]["columns"]:
+                if entry["dtype"] != "float" or needle not in entry["name"].lower() or "min" not in entry:
+                    continue
+                if entry["max"] < low or entry["min"] > high:
+                    continue
+                values = self.load(table_id, [entry["name"]])[entry["name"]].to_numpy()
+                rows = np.nonzero((values >= low) & (values <= high))[0]
+                if len(rows):
+                    matches.append({"table_id": table_id, "column": entry["name"], "rows": rows.tolist()})
+        return matches
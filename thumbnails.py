@@ -0,0 +1,271 @@
+"""
+Cached first-page and figure thumbnails for the file list.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fitz  # PyMuPDF
+
+# PyMuPDF is not thread-safe, so every fitz call made off the main thread
+# anywhere in Ralph holds this lock
+FITZ_LOCK = threading.Lock()
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    # Hash the file contents so a moved or renamed PDF keeps its thumbnails
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _zoom_for(rect, max_size):
+    # Scale factor that fits rect inside a max_size x max_size box
+    longest = max(rect.width, rect.height)
+    if longest <= 0:
+        return 1.0
+    return max_size / longest
+
+
+def render_page_thumbnail(pdf_path, page_num=0, max_size=160):
+    with FITZ_LOCK, fitz.open(pdf_path) as pdf:
+        page = pdf.load_page(page_num)
+        zoom = _zoom_for(page.rect, max_size)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return pix.tobytes("png")
+
+
+def render_figure_thumbnails(pdf_path, max_size=160, max_figures=8):
+    """
+    Renders the page region under each embedded image, so figures made of
+    several image tiles still come out as they appear on the page.
+    """
+    thumbnails = []
+    with FITZ_LOCK, fitz.open(pdf_path) as pdf:
+        for page in pdf:
+            for img in page.get_images(full=True):
+                try:
+                    img_rect = page.get_image_bbox(img[7])
+                except ValueError:
+                    continue
+                if img_rect.is_empty or img_rect.is_infinite:
+                    continue
+                zoom = _zoom_for(img_rect, max_size)
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=img_rect, alpha=False)
+                thumbnails.append(pix.tobytes("png"))
+                if len(thumbnails) >= max_figures:
+                    return thumbnails
+    return thumbnails
+
+
+class ThumbnailCache:
+    """
+    On-disk PNG cache keyed by content hash, with a byte cap and LRU eviction,
+    fronted by a small in-memory LRU for the file list. Hashing and disk reads
+    happen on a background pool; renders also run there but one at a time,
+    behind FITZ_LOCK. Callers get the PNG bytes through a callback.
+    """
+
+    def __init__(self, cache_dir="./thumbnails", max_disk_bytes=256 * 1024 * 1024,
+                 memory_items=256, max_size=160, workers=2):
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_items = memory_items
+        self.max_size = max_size
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()   # cache key -> png bytes
+        self._hashes = {}              # path -> ((mtime, size), content hash)
+        self._pending = {}             # cache key -> [callbacks]
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+
+        # Content hashes survive restarts, so known PDFs are never re-read just to
+        # find their thumbnails: an append-only log, compacted like DocIndex
+        self.hashes_path = os.path.join(self.cache_dir, "hashes.jsonl")
+        self._hash_lines = 0
+        if os.path.exists(self.hashes_path):
+            with open(self.hashes_path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self._hashes[entry["path"]] = ((entry["mtime"], entry["size"]), entry["hash"])
+                    self._hash_lines += 1
+            if self._hash_lines > 2 * len(self._hashes) + 100:
+                self._compact_hashes()
+
+        # Disk index ordered oldest access first, rebuilt from file mtimes
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".png"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._disk[name] = size
+            self._disk_bytes += size
+        return
+
+    def _compact_hashes(self):
+        # Caller holds the lock, or is __init__
+        with open(self.hashes_path + ".tmp", "w") as f:
+            for path, ((mtime, size), digest) in self._hashes.items():
+                f.write(json.dumps({"path": path, "mtime": mtime, "size": size, "hash": digest}) + "\n")
+        os.replace(self.hashes_path + ".tmp", self.hashes_path)
+        self._hash_lines = len(self._hashes)
+        return
+
+    def content_hash(self, pdf_path):
+        stat = os.stat(pdf_path)
+        signature = (stat.st_mtime, stat.st_size)
+        cached = self._hashes.get(pdf_path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        digest = _file_hash(pdf_path)
+        with self._lock:
+            self._hashes[pdf_path] = (signature, digest)
+            with open(self.hashes_path, "a") as f:
+                f.write(json.dumps({"path": pdf_path, "mtime": stat.st_mtime, "size": stat.st_size,
+                                    "hash": digest}) + "\n")
+            self._hash_lines += 1
+            if self._hash_lines > 2 * len(self._hashes) + 100:
+                self._compact_hashes()
+        return digest
+
+    def _key(self, digest, kind, index):
+        return f"{digest}_{kind}_{index}_{self.max_size}.png"
+
+    def _remember(self, key, png):
+        # Caller holds the lock
+        self._memory[key] = png
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if key not in self._disk:
+                return None
+            self._disk.move_to_end(key)
+
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, "rb") as f:
+                png = f.read()
+            os.utime(path)  # Keeps the LRU order across restarts
+        except OSError:
+            with self._lock:
+                self._disk_bytes -= self._disk.pop(key, 0)
+            return None
+
+        with self._lock:
+            self._remember(key, png)
+        return png
+
+    def _store(self, key, png):
+        path = os.path.join(self.cache_dir, key)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(png)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(key, 0)
+            self._disk[key] = len(png)
+            self._disk_bytes += len(png)
+            self._remember(key, png)
+            evicted = []
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                old_key, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self._memory.pop(old_key, None)
+                evicted.append(old_key)
+
+        for old_key in evicted:
+            try:
+                os.remove(os.path.join(self.cache_dir, old_key))
+            except OSError:
+                pass
+        return
+
+    def get(self, pdf_path, kind="page", index=0):
+        """
+        Returns PNG bytes from the in-memory LRU, or None on a miss. Touches
+        neither the PDF nor the disk cache, so it is cheap enough for the UI
+        thread; on a miss, request() checks both on the background pool.
+        """
+        with self._lock:
+            cached = self._hashes.get(pdf_path)
+            if not cached:
+                return None
+            key = self._key(cached[1], kind, index)
+            if key not in self._memory:
+                return None
+            self._memory.move_to_end(key)
+            return self._memory[key]
+
+    def _render(self, pdf_path, kind, index):
+        if kind == "page":
+            return [render_page_thumbnail(pdf_path, index, self.max_size)]
+        return render_figure_thumbnails(pdf_path, self.max_size)
+
+    def _run(self, pdf_path, kind, index):
+        png = None
+        try:
+            digest = self.content_hash(pdf_path)
+            key = self._key(digest, kind, index)
+            png = self._lookup(key)
+            if png is None:
+                rendered = self._render(pdf_path, kind, index)
+                if kind == "figure":
+                    # One render pass yields every figure, so store them all
+                    for fig_index, fig_png in enumerate(rendered):
+                        self._store(self._key(digest, kind, fig_index), fig_png)
+                    png = rendered[index] if index < len(rendered) else None
+                else:
+                    png = rendered[0]
+                    self._store(key, png)
+        except Exception as e:
+            print(f"Thumbnail failed for {pdf_path}: {e}")
+
+        with self._lock:
+            callbacks = self._pending.pop((pdf_path, kind, index), [])
+        for callback in callbacks:
+            callback(pdf_path, png)
+        return png
+
+    def request(self, pdf_path, callback=None, kind="page", index=0):
+        """
+        Schedules a render on the background pool. The callback receives
+        (pdf_path, png_bytes or None) on a worker thread.
+        """
+        job = (pdf_path, kind, index)
+        with self._lock:
+            if job in self._pending:
+                if callback:
+                    self._pending[job].append(callback)
+                return
+            self._pending[job] = [callback] if callback else []
+        self._pool.submit(self._run, pdf_path, kind, index)
+        return
+
+    def prefetch(self, pdf_path):
+        # Called at ingest so the list and previews are warm before first view
+        self.request(pdf_path, kind="page")
+        self.request(pdf_path, kind="figure")
+        return
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        return